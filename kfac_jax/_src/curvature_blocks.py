@@ -1161,9 +1161,10 @@ class KroneckerFactored(CurvatureBlock, abc.ABC):
         ]
 
       else:
-        s, q = zip(
-            *[utils.safe_psd_eigh(factor.value) for factor in state.factors]
-        )
+        s, q = zip(*[
+            utils.safe_psd_eigh(factor.value, sort_eigenvalues=False)
+            for factor in state.factors
+        ])
 
       eigenvalues = utils.outer_product(*s) + identity_weight
       eigenvalues = jnp.power(eigenvalues, power)
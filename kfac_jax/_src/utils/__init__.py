@@ -111,6 +111,9 @@ psd_inv_cholesky = math.psd_inv_cholesky
 pi_adjusted_kronecker_inverse = math.pi_adjusted_kronecker_inverse
 kronecker_product_axis_mul_v = math.kronecker_product_axis_mul_v
 kronecker_eigen_basis_axis_mul_v = math.kronecker_eigen_basis_axis_mul_v
+jit_kronecker_product_axis_mul_v = math.jit_kronecker_product_axis_mul_v
+jit_kronecker_eigen_basis_axis_mul_v = (
+    math.jit_kronecker_eigen_basis_axis_mul_v)
 kronecker_product_mul_v = math.kronecker_product_mul_v
 kronecker_eigen_basis_mul_v = math.kronecker_eigen_basis_mul_v
 safe_psd_eigh = math.safe_psd_eigh
@@ -13,7 +13,8 @@
 # limitations under the License.
 """K-FAC utilities for various mathematical operations."""
 import functools
-import string
+import math
+import operator
 from typing import Callable, Optional, Sequence, Iterable, TypeVar, Tuple, Union
 
 import jax
@@ -36,8 +37,6 @@ ArrayTree = types.ArrayTree
 TArrayTree = types.TArrayTree
 TNumeric = TypeVar("TNumeric", bound=Numeric)
 
-_ALPHABET = string.ascii_lowercase
-
 # If true we use a special case formula for when a block has one or more zero
 # factors.
 _SPECIAL_CASE_ZERO_INV: bool = True
@@ -56,21 +55,31 @@ def get_special_case_zero_inv() -> bool:
 
 def product(iterable_object: Iterable[TNumeric]) -> TNumeric:
   """Computes the product of all elements in the iterable."""
-  x = 1
+  elements = tuple(iterable_object)
 
-  for element in iterable_object:
-    x = x * element
+  # For plain Python numbers (e.g. shapes) `math.prod` avoids the interpreter
+  # loop. For arrays we start from the first element rather than from `1`, to
+  # avoid an unnecessary weak-type promotion of the initial value.
+  if all(isinstance(e, types.SCALAR_TYPES) for e in elements):
+    return math.prod(elements)
 
-  return x
+  return functools.reduce(operator.mul, elements)
 
 
 def outer_product(*arrays: Array) -> Array:
   """Computes the outer product of an arbitrary number of vectors."""
   if not all(a.ndim == 1 for a in arrays):
     raise ValueError("All arrays must be vectors.")
-  in_str = ",".join(_ALPHABET[:len(arrays)])
-  out_str = _ALPHABET[:len(arrays)]
-  return jnp.einsum(f"{in_str}->{out_str}", *arrays)
+
+  # Each vector is reshaped to have a single non-trivial axis at its own
+  # position, so that the product is a plain broadcasted multiplication.
+  n = len(arrays)
+  result = arrays[0].reshape(arrays[0].shape + (1,) * (n - 1))
+
+  for i, a in enumerate(arrays[1:], start=1):
+    result = result * a.reshape((1,) * i + a.shape + (1,) * (n - i - 1))
+
+  return result
 
 
 def scalar_mul(obj: TArrayTree, scalar: Numeric) -> TArrayTree:
@@ -122,16 +131,44 @@ def weighted_sum_of_objects(
   if not objects:
     raise ValueError("The objects' sequences can not be empty.")
 
-  accumulator = scalar_mul(objects[0], coefficients[0])
-
-  for o_i, c_i in zip(objects[1:], coefficients[1:]):
-    if not types.abstract_objects_equal(accumulator, o_i):
+  for o_i in objects[1:]:
+    if not types.abstract_objects_equal(objects[0], o_i):
       raise ValueError("One or more objects do not have equivalent abstract "
                        "structure.")
-    accumulator = jax.tree_util.tree_map(
-        jnp.add, accumulator, scalar_mul(o_i, c_i))
 
-  return accumulator
+  # Objects whose coefficient is a concrete zero do not contribute to the sum,
+  # so we drop them altogether. As in `scalar_mul`, we can only check this for
+  # native python scalars.
+  non_zero_terms = [
+      (o_i, c_i) for o_i, c_i in zip(objects, coefficients)
+      if not (isinstance(c_i, types.SCALAR_TYPES) and c_i == 0.0)
+  ]
+
+  if not non_zero_terms:
+    return jax.tree_util.tree_map(jnp.zeros_like, objects[0])
+
+  objects, coefficients = zip(*non_zero_terms)
+
+  def is_one(scalar: Numeric) -> bool:
+    return isinstance(scalar, types.SCALAR_TYPES) and scalar == 1.0
+
+  # All objects are combined in a single pass over their PyTree leaves. Each
+  # step is written as a multiply-add into the accumulator, which XLA fuses
+  # into a single kernel without materializing the scaled copies.
+  def weighted_sum_of_leaves(*leaves: Array) -> Array:
+
+    accumulator = None
+
+    for x, c_i in zip(leaves, coefficients):
+
+      if not is_one(c_i):
+        x = c_i * x
+
+      accumulator = x if accumulator is None else accumulator + x
+
+    return accumulator
+
+  return jax.tree_util.tree_map(weighted_sum_of_leaves, *objects)
 
 
 def _inner_product_float64(obj1: ArrayTree, obj2: ArrayTree) -> Array:
@@ -190,10 +227,30 @@ def inner_product(
   if in_float64:
     return _inner_product_float64(obj1, obj2)
 
-  elements_product = jax.tree_util.tree_map(
-      lambda x, y: jnp.sum(x * y), obj1, obj2)
+  # Using `vdot` lowers each leaf to a single `dot_general`, rather than an
+  # elementwise product followed by a separate reduction.
+  def array_ip(x, y):
+    return jnp.vdot(x.ravel(), y.ravel(), precision=lax.Precision.HIGHEST)
 
-  return sum(jax.tree_util.tree_leaves(elements_product))
+  elements_product = jax.tree_util.tree_map(array_ip, obj1, obj2)
+
+  leaves = jax.tree_util.tree_leaves(elements_product)
+
+  if not leaves:
+    return jnp.zeros([])
+
+  return jnp.sum(jnp.stack(leaves))
+
+
+def _stack_flattened_vectors(vectors: Sequence[ArrayTree]) -> ArrayTree:
+  """Stacks the flattened leaves of all vectors into `[n, leaf_size]` arrays."""
+
+  if not all(types.abstract_objects_equal(vectors[0], v, check_dtype=False)
+             for v in vectors[1:]):
+    raise ValueError("The objects do not have identical abstract structure.")
+
+  return jax.tree_util.tree_map(
+      lambda *xs: jnp.stack([x.ravel() for x in xs]), *vectors)
 
 
 def symmetric_matrix_inner_products(
@@ -218,6 +275,27 @@ def symmetric_matrix_inner_products(
   if len(vectors1) != len(vectors2):
     raise ValueError("The two sequences should have the same length.")
 
+  if ip_function is inner_product and vectors1:
+
+    # All inner products are computed with a single matrix multiplication per
+    # PyTree leaf, instead of a separate `inner_product` call for each pair.
+    stacked1 = _stack_flattened_vectors(vectors1)
+    stacked2 = (stacked1 if vectors2 is vectors1 else
+                _stack_flattened_vectors(vectors2))
+
+    if not types.abstract_objects_equal(
+        stacked1, stacked2, check_dtype=False):
+      raise ValueError("The objects do not have identical abstract structure.")
+
+    per_leaf_products = jax.tree_util.tree_map(
+        lambda a, b: jnp.matmul(a, b.T, precision=lax.Precision.HIGHEST),
+        stacked1, stacked2)
+
+    m = sum(jax.tree_util.tree_leaves(per_leaf_products))
+
+    # Only the upper triangle `i <= j` is used, mirrored to the lower one.
+    return jnp.triu(m) + jnp.triu(m, 1).T
+
   m = [[] for _ in vectors1]
   for i, v_i in enumerate(vectors1):
     for j, v_j in enumerate(vectors2):
@@ -265,6 +343,21 @@ def vector_of_inner_products(
   Returns:
     A vector `v` with elements `v[i] = <base, vectors[i]>`.
   """
+  if ip_function is inner_product and vectors:
+
+    # A single matrix-vector product per PyTree leaf.
+    stacked = _stack_flattened_vectors(vectors)
+
+    if not types.abstract_objects_equal(
+        vectors[0], base, check_dtype=False):
+      raise ValueError("The objects do not have identical abstract structure.")
+
+    per_leaf_products = jax.tree_util.tree_map(
+        lambda a, b: jnp.matmul(a, b.ravel(), precision=lax.Precision.HIGHEST),
+        stacked, base)
+
+    return sum(jax.tree_util.tree_leaves(per_leaf_products))
+
   v = []
   for v_i in vectors:
     v.append(ip_function(v_i, base))
@@ -272,6 +365,19 @@ def vector_of_inner_products(
   return jnp.asarray(v)
 
 
+@functools.lru_cache(maxsize=128)
+def _block_permutation_indices(
+    block_sizes: Tuple[int, ...],
+    block_order: Tuple[int, ...],
+) -> np.ndarray:
+  """Returns the indices permuting whole blocks, as used by `block_permuted`."""
+
+  offsets = np.concatenate([[0], np.cumsum(block_sizes)])
+
+  return np.concatenate(
+      [np.arange(offsets[i], offsets[i + 1]) for i in block_order])
+
+
 def block_permuted(
     matrix: Array,
     block_sizes: Sequence[int],
@@ -304,19 +410,27 @@ def block_permuted(
   if all(i == j for i, j in enumerate(block_order)):
     return matrix
 
-  indices = np.cumsum(block_sizes)[:-1]
-  blocks = [jnp.split(row, indices, 1) for row in jnp.split(matrix, indices, 0)]
-  reordered_blocks = [[blocks[i][j] for j in block_order] for i in block_order]
+  perm = _block_permutation_indices(
+      tuple(int(size) for size in block_sizes),
+      tuple(int(i) for i in block_order),
+  )
 
-  return jnp.block(reordered_blocks)
+  return matrix[perm][:, perm]
 
 
 def norm(obj: ArrayTree) -> Array:
   """Computes the Euclidean norm of the provided PyTree object."""
-  elements_squared_norm = jax.tree_util.tree_map(
-      lambda x: jnp.sum(jnp.square(x)), obj)
+  leaves = jax.tree_util.tree_leaves(obj)
+  dtype = leaves[0].dtype if leaves else None
+
+  # Using `vdot` avoids materializing the squared leaves as separate buffers.
+  def add_squared_norm(acc, x):
+    return acc + jnp.vdot(x.ravel(), x.ravel(), precision=lax.Precision.HIGHEST)
 
-  return jnp.sqrt(sum(jax.tree_util.tree_leaves(elements_squared_norm)))
+  squared_norm = jax.tree_util.tree_reduce(
+      add_squared_norm, obj, jnp.zeros([], dtype=dtype))
+
+  return jnp.sqrt(squared_norm)
 
 
 def per_parameter_norm(obj: ArrayTree, key_prefix: str) -> ArrayTree:
@@ -337,7 +451,10 @@ def psd_inv_cholesky(matrix: Array, damping: Array) -> Array:
 
   identity = jnp.eye(matrix.shape[0], dtype=matrix.dtype)
 
-  return linalg.solve(matrix + damping * identity, identity, assume_a="pos")
+  # A single Cholesky factorization followed by a pair of triangular solves.
+  factor = linalg.cho_factor(matrix + damping * identity, lower=True)
+
+  return linalg.cho_solve(factor, identity)
 
 
 def psd_matrix_norm(
@@ -478,28 +595,35 @@ def pi_adjusted_kronecker_inverse(
 
   norms = [psd_matrix_norm(a, norm_type=norm_type) for a in arrays]
 
-  # Compute the normalized factors `u_i`, such that Trace(u_i) / dim(u_i) = 1
-  us = [ai / ni for ai, ni in zip(arrays, norms)]
-
   # kron(arrays) = c * kron(us)
 
   c = jnp.prod(jnp.array(norms))
 
   damping = damping.astype(c.dtype)  # pytype: disable=attribute-error  # numpy-scalars
 
-  def regular_inverse() -> Tuple[Array, ...]:
+  def normalized_factors(
+      arrays: Sequence[Array],
+      norms: Sequence[Array],
+  ) -> Sequence[Array]:
+    # Compute the normalized factors `u_i`, such that Trace(u_i) / dim(u_i) = 1
+    return [ai / ni for ai, ni in zip(arrays, norms)]
 
-    non_scalars = sum(1 if a.size != 1 else 0 for a in arrays)
+  def regular_inverse(c: Array, us: Sequence[Array]) -> Tuple[Array, ...]:
 
-    # We distribute the damping only inside the non-scalar factors
-    d_hat = jnp.power(damping / c, 1.0 / non_scalars)
+    non_scalars = sum(1 if a.size != 1 else 0 for a in arrays)
 
     # We distribute the overall scale over each factor, including scalars
     if non_scalars == 0:
       # In the case where all factors are scalar we need to add the damping
-      c_k = jnp.power(c + damping, 1.0 / len(arrays))
+      c_k = lax.pow(c + damping, jnp.asarray(1.0 / len(arrays), c.dtype))
     else:
-      c_k = jnp.power(c, 1.0 / len(arrays))
+      c_k = lax.pow(c, jnp.asarray(1.0 / len(arrays), c.dtype))
+
+      # We distribute the damping only inside the non-scalar factors
+      d_hat = lax.pow(damping / c, jnp.asarray(1.0 / non_scalars, c.dtype))
+
+    # The reciprocal of the scale is computed only once for all factors
+    c_k_inv = 1.0 / c_k
 
     u_hats_inv = []
 
@@ -515,7 +639,7 @@ def pi_adjusted_kronecker_inverse(
         assert u.ndim == 1
         inv = 1.0 / (u + d_hat)
 
-      u_hats_inv.append(inv / c_k)
+      u_hats_inv.append(inv * c_k_inv)
 
     return tuple(u_hats_inv)
 
@@ -529,13 +653,13 @@ def pi_adjusted_kronecker_inverse(
 
     u_hats_inv = []
 
-    for u in us:
+    for a in arrays:
 
-      if u.ndim == 2:
-        inv = jnp.eye(u.shape[0], dtype=u.dtype)
+      if a.ndim == 2:
+        inv = jnp.eye(a.shape[0], dtype=a.dtype)
 
       else:
-        inv = jnp.ones_like(u)
+        inv = jnp.ones_like(a)
 
       u_hats_inv.append(inv / c_k)
 
@@ -543,13 +667,75 @@ def pi_adjusted_kronecker_inverse(
 
   if get_special_case_zero_inv():
 
-    return lax.cond(
-        jnp.greater(c, 0.0),
-        regular_inverse,
-        zero_inverse)
+    # Both branches are computed and the result is selected elementwise, which
+    # avoids a conditional in the graph and allows XLA to fuse across factors.
+    # Since the regular branch is always computed, when its result is not used
+    # we feed it with zero factors and unit norms instead, so that no NaNs
+    # (e.g. from zero or NaN factors) reach the Cholesky decompositions.
+    is_regular = jnp.greater(c, 0.0)
+
+    safe_arrays = [jnp.where(is_regular, a, jnp.zeros_like(a)) for a in arrays]
+    safe_norms = [jnp.where(is_regular, n, jnp.ones_like(n)) for n in norms]
+
+    regular = regular_inverse(
+        jnp.where(is_regular, c, jnp.ones_like(c)),
+        normalized_factors(safe_arrays, safe_norms),
+    )
+    zero = zero_inverse()
+
+    return tuple(jnp.where(is_regular, r, z) for r, z in zip(regular, zero))
 
   else:
-    return regular_inverse()
+    return regular_inverse(c, normalized_factors(arrays, norms))
+
+
+@functools.lru_cache(maxsize=1024)
+def _kronecker_product_axis_contraction_specs(
+    shape: Tuple[int, ...],
+    axis_groups: Tuple[Tuple[int, ...], ...],
+    transpose: Tuple[bool, ...],
+    num_factors: int,
+) -> Tuple[Tuple[int, Optional[Tuple[int, ...]], int], ...]:
+  """Returns the contraction specs used by `kronecker_product_axis_mul_v`.
+
+  The specs depend only on static properties of the arguments, and are hence
+  cached to avoid recomputing them on every call.
+
+  Args:
+    shape: The shape of the input tensor ``v``.
+    axis_groups: The axis groups of each factor, as a tuple of tuples.
+    transpose: Whether each factor should be transposed, as a tuple.
+    num_factors: The number of factors.
+
+  Returns:
+    For each factor, a tuple of the axis of ``v`` it acts on, the shape of ``v``
+    with all axes in its group flattened into a single one (or ``None`` when
+    the group is a single axis), and the axis of the factor that is contracted.
+  """
+
+  # Sanity checks
+  if sum(axis_groups, ()) != tuple(range(len(shape))):
+    raise ValueError(f"The `axis_groups={axis_groups}` are either not in "
+                     f"consecutive order or do not cover exactly the axis of "
+                     f"the input `v`..")
+  if num_factors != len(axis_groups):
+    raise ValueError("The number of factors provided must be equal to the "
+                     "number of axis groups provided.")
+  if len(transpose) != num_factors:
+    raise ValueError("The length of the transpose sequence must match the "
+                     "number of factors.")
+
+  contraction_specs = []
+  for group, t in zip(axis_groups, transpose):
+
+    if len(group) > 1:
+      flat_shape = shape[:min(group)] + (-1,) + shape[max(group) + 1:]
+    else:
+      flat_shape = None
+
+    contraction_specs.append((min(group), flat_shape, 0 if t else 1))
+
+  return tuple(contraction_specs)
 
 
 def kronecker_product_axis_mul_v(
@@ -581,40 +767,27 @@ def kronecker_product_axis_mul_v(
   else:
     axis_groups = tuple(tuple(group) for group in axis_groups)
 
-  # Sanity checks
-  if sum(axis_groups, ()) != tuple(range(v.ndim)):
-    raise ValueError(f"The `axis_groups={axis_groups}` are either not in "
-                     f"consecutive order or do not cover exactly the axis of "
-                     f"the input `v`..")
-  if len(factors) != len(axis_groups):
-    raise ValueError("The number of factors provided must be equal to the "
-                     "number of axis groups provided.")
-
   if isinstance(transpose, bool):
-    transpose = [transpose] * len(factors)
-
-  elif len(transpose) != len(factors):
-    raise ValueError("The length of the transpose sequence must match the "
-                     "number of factors.")
+    transpose = (transpose,) * len(factors)
+  else:
+    transpose = tuple(transpose)
 
-  factor_strs = ["yz" if t else "zy" for t in transpose]
-  general_str = _ALPHABET[:v.ndim]
+  contraction_specs = _kronecker_product_axis_contraction_specs(
+      v.shape, axis_groups, transpose, len(factors))
 
   result = v
-  for group, factor, f_str in zip(axis_groups, factors, factor_strs):
+  for factor, (axis, flat_shape, factor_axis) in zip(
+      factors, contraction_specs):
 
-    # This flattens all axis in `group` of `result` into a single one.
-    shape = v.shape[:min(group)] + (-1,) + v.shape[max(group) + 1:]
-    vector = result.reshape(shape)
+    vector = result if flat_shape is None else result.reshape(flat_shape)
 
-    # This contracts `result` with `factor` along the single axis.
-    vector_str = general_str[:min(group)] + "y" + general_str[max(group) + 1:]
-    result_str = vector_str.replace("y", "z")
-    einsum_str = f"{f_str},{vector_str}->{result_str}"
-    r_next = jnp.einsum(einsum_str, factor, vector)
+    # This contracts `vector` with `factor` along the single axis, and moves
+    # the new axis (placed first by `tensordot`) back to its position.
+    r_next = jnp.tensordot(factor, vector, axes=[[factor_axis], [axis]])
+    r_next = jnp.moveaxis(r_next, 0, axis)
 
     # This reshapes back to the original shape.
-    result = r_next.reshape(v.shape)
+    result = r_next if flat_shape is None else r_next.reshape(v.shape)
 
   return result
 
@@ -652,6 +825,24 @@ def kronecker_eigen_basis_axis_mul_v(
     The result of multiplying the input vector by the Kronecker product of the
     factors, shaped as a tensor.
   """
+  if axis_groups is not None:
+    axis_groups = tuple(tuple(group) for group in axis_groups)
+
+  return _kronecker_eigen_basis_axis_mul_v(
+      tuple(q_factors), eigenvalues, v, axis_groups)
+
+
+@functools.partial(jax.jit, static_argnames=("axis_groups",))
+def _kronecker_eigen_basis_axis_mul_v(
+    q_factors: Tuple[Array, ...],
+    eigenvalues: Array,
+    v: Array,
+    axis_groups: Optional[Tuple[Tuple[int, ...], ...]],
+) -> Array:
+  """Jitted implementation of `kronecker_eigen_basis_axis_mul_v`."""
+
+  # Staging the whole computation together allows XLA to fuse the elementwise
+  # scaling with the projections, rather than materializing `q_proj_v`.
   q_proj_v = kronecker_product_axis_mul_v(q_factors, v, axis_groups, True)
 
   if eigenvalues.shape != q_proj_v.shape:
@@ -663,6 +854,23 @@ def kronecker_eigen_basis_axis_mul_v(
   return kronecker_product_axis_mul_v(q_factors, eig_weighted_v, axis_groups)
 
 
+# Jitted versions of `kronecker_product_axis_mul_v` and
+# `kronecker_eigen_basis_axis_mul_v`, which donate the buffer of the input `v`
+# to the output (the caller must not use `v` after the call). The arguments
+# `axis_groups` and `transpose` are static, and hence must be passed as hashable
+# values, e.g. tuples.
+jit_kronecker_product_axis_mul_v = jax.jit(
+    kronecker_product_axis_mul_v,
+    static_argnames=("axis_groups", "transpose"),
+    donate_argnums=1,
+)
+jit_kronecker_eigen_basis_axis_mul_v = jax.jit(
+    kronecker_eigen_basis_axis_mul_v,
+    static_argnames=("axis_groups",),
+    donate_argnums=2,
+)
+
+
 def kronecker_product_mul_v(
     a: Array,
     b: Array,
@@ -711,19 +919,39 @@ def _host_eigh(x: Array, *_) -> Tuple[Array, Array]:
   shape_s = jax.ShapeDtypeStruct(x.shape[:-1], x.dtype)
   shape_q = jax.ShapeDtypeStruct(x.shape, x.dtype)
 
-  return jax.pure_callback(np.linalg.eigh, (shape_s, shape_q), x)
+  # The numpy function supports leading batch dimensions, hence the callback is
+  # vectorized. This way a stack of matrices (or a `vmap` over this function)
+  # results in a single transfer to and from the host, rather than one for each
+  # matrix.
+  return jax.pure_callback(
+      np.linalg.eigh, (shape_s, shape_q), x, vectorized=True)
+
+
+def _device_eigh(
+    x: Array,
+    sort_eigenvalues: bool = True,
+) -> Tuple[Array, Array]:
+  """Computes eigenvalues and eigenvectors on the default device."""
+
+  if sort_eigenvalues:
+    return jnp.linalg.eigh(x)
+
+  q, s = lax.linalg.eigh(x, lower=True, sort_eigenvalues=False)
+
+  return s, q
 
 
 def _eigh(
     x: Array,
     force_on_host: bool = False,
+    sort_eigenvalues: bool = True,
 ) -> Tuple[Array, Array]:
   """Computes eigenvectors and eigenvalues, with optionally offloading to cpu."""
 
   if force_on_host:
     return _host_eigh(x)
 
-  s, q = jnp.linalg.eigh(x)
+  s, q = _device_eigh(x, sort_eigenvalues=sort_eigenvalues)
 
   # Recently with CUDA 11.7 there is a bug in cuSOLVER which makes the eigh
   # implementation unstable sometimes on GPUs.
@@ -738,6 +966,9 @@ def _eigh(
 def safe_psd_eigh(
     x: Array,
     force_on_host: bool = False,
+    assume_finite: bool = False,
+    compute_dtype: Optional[types.DType] = None,
+    sort_eigenvalues: bool = True,
 ) -> Tuple[Array, Array]:
   """Computes the eigenvalue decomposition for a PSD matrix.
 
@@ -746,14 +977,68 @@ def safe_psd_eigh(
   PSD matrices, but due to numerical errors `jax.numpy.linalg.eigh` could return
   negative values.
 
+  By default, the function guards against NaNs both in the input and in the
+  output of the device eigh, in which case it falls back to computing the
+  decomposition on the host via `jax.pure_callback`. The guards are two extra
+  conditionals, and the fallback incurs a device to host transfer which blocks
+  the computation stream, so in performance critical code where the input is
+  known to be finite it is preferable to pass `assume_finite=True`.
+
   Args:
-    x: The input matrix, assumed to be PSD.
+    x: The input matrix, assumed to be PSD. Can also be a stack of such matrices
+      with arbitrary leading batch dimensions, in which case they are all
+      decomposed together (and with a single host transfer if on the host).
     force_on_host: If `True` will perform the computation on the host CPU.
+    assume_finite: If `True` the input is assumed to contain no NaNs and both
+      NaN checks are skipped, performing a single eigenvalue decomposition.
+    compute_dtype: If provided, the decomposition is computed in this dtype and
+      the results are cast back to the dtype of `x`. The dtype must be
+      supported by the eigh implementation of the backend (e.g. half precision
+      types are currently not supported by XLA).
+    sort_eigenvalues: Whether to sort the eigenvalues in ascending order. If the
+      caller uses the eigenvalues only elementwise together with their
+      eigenvectors, passing `False` skips the sorting on the device. The host
+      computation always returns them sorted.
 
   Returns:
     A pair of (eigenvalues, eigenvectors) arrays.
   """
 
+  if compute_dtype is not None and jnp.dtype(compute_dtype) != x.dtype:
+
+    s, q = safe_psd_eigh(
+        x.astype(compute_dtype),
+        force_on_host=force_on_host,
+        assume_finite=assume_finite,
+        sort_eigenvalues=sort_eigenvalues,
+    )
+
+    return s.astype(x.dtype), q.astype(x.dtype)
+
+  if assume_finite:
+    if force_on_host:
+      s, q = _host_eigh(x)
+    else:
+      s, q = _device_eigh(x, sort_eigenvalues=sort_eigenvalues)
+
+    return lax.max(s, jnp.zeros([], dtype=s.dtype)), q
+
+  if x.ndim > 2:
+
+    # For a stack of matrices, any matrix containing NaNs is replaced by the
+    # identity before the decomposition, and its outputs are set to NaN.
+    is_nan = jnp.any(jnp.isnan(x), axis=(-2, -1))
+    identity = jnp.eye(x.shape[-1], dtype=x.dtype)
+
+    s, q = _eigh(jnp.where(is_nan[..., None, None], identity, x),
+                 force_on_host=force_on_host,
+                 sort_eigenvalues=sort_eigenvalues)
+
+    s = jnp.where(is_nan[..., None], jnp.nan, s)
+    q = jnp.where(is_nan[..., None, None], jnp.nan, q)
+
+    return lax.max(s, jnp.zeros([], dtype=s.dtype)), q
+
   d = x.shape[0]
 
   # Here we are handling the case of NaNs separately, because in some versions
@@ -762,13 +1047,14 @@ def safe_psd_eigh(
       jnp.any(jnp.isnan(x)),
       lambda _: (jnp.full([d], jnp.nan, dtype=x.dtype),  # pylint: disable=g-long-lambda
                  jnp.full([d, d], jnp.nan, dtype=x.dtype)),
-      functools.partial(_eigh, force_on_host=force_on_host),
+      functools.partial(_eigh, force_on_host=force_on_host,
+                        sort_eigenvalues=sort_eigenvalues),
       x,
   )
 
   # The matrix is PSD by construction, but numerical inaccuracies can produce
   # slightly negative eigenvalues. Hence, clip at zero.
-  return jnp.clip(s, a_min=0.0), q
+  return lax.max(s, jnp.zeros([], dtype=s.dtype)), q
 
 
 def loop_and_parallelize_average(
@@ -797,6 +1083,12 @@ def loop_and_parallelize_average(
   """
   vmap_fn = jax.vmap(func)
 
+  def mean_vmap_fn(*args_) -> ArrayTree:
+    return jax.tree_util.tree_map(
+        lambda x: jnp.mean(x, axis=0), vmap_fn(*args_))
+
+  output_trees_cache = {}
+
   @functools.wraps(func)
   def average_func(*args) -> ArrayTree:
 
@@ -812,8 +1104,19 @@ def loop_and_parallelize_average(
 
     leading_size = next(iter(lead_axis_sizes))
 
-    singleton_args = jax.tree_util.tree_map(lambda _x: _x[0], args)
-    _, output_tree = jax.make_jaxpr(func, return_shape=True)(*singleton_args)
+    # The output structure of `func` depends only on the structure, shapes and
+    # dtypes of its arguments, so we trace it only once for each of them.
+    singleton_args = jax.tree_util.tree_map(
+        lambda _x: jax.ShapeDtypeStruct(_x.shape[1:], _x.dtype), args)
+    cache_key = (
+        jax.tree_util.tree_structure(singleton_args),
+        tuple(jax.tree_util.tree_leaves(singleton_args)),
+    )
+
+    if cache_key not in output_trees_cache:
+      output_trees_cache[cache_key] = jax.eval_shape(func, *singleton_args)
+
+    output_tree = output_trees_cache[cache_key]
 
     singleton_size = sum(x.size for x in jax.tree_util.tree_leaves(output_tree))
     output_size = singleton_size * leading_size
@@ -839,17 +1142,15 @@ def loop_and_parallelize_average(
     loop_args = jax.tree_util.tree_map(lambda x: x[:all_chunks_size], args)
 
     if num_parallel_chunks == 1:
-      averaged_value = jnp.mean(vmap_fn(*loop_args), axis=0)
+      averaged_value = mean_vmap_fn(*loop_args)
 
     else:
 
+      # Note that we accumulate the chunk averages in the carry, rather than
+      # using `jax.lax.map`, as the latter would stack the outputs of all chunks
+      # and hence defeat the purpose of bounding the memory usage.
       def scan_fn(accumulator, args_):
-
-        vmap_value = vmap_fn(*args_)
-
-        avg_value = jax.tree_util.tree_map(
-            lambda x: jnp.mean(x, axis=0), vmap_value)
-
+        avg_value = mean_vmap_fn(*args_)
         return jax.tree_util.tree_map(jnp.add, accumulator, avg_value), None
 
       loop_shape = (num_parallel_chunks, parallel_size)
@@ -871,7 +1172,7 @@ def loop_and_parallelize_average(
 
     # Index to get the remainder arguments
     remainder_args = jax.tree_util.tree_map(lambda x: x[all_chunks_size:], args)
-    remainder_value = jnp.mean(vmap_fn(*remainder_args), axis=0)
+    remainder_value = mean_vmap_fn(*remainder_args)
 
     avg_weight = all_chunks_size / leading_size
     remainder_weight = remainder_size / leading_size
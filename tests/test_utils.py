@@ -0,0 +1,219 @@
+# Copyright 2022 DeepMind Technologies Limited. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Testing the functionality of the math utilities."""
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+import jax
+import jax.numpy as jnp
+import kfac_jax
+from kfac_jax._src.utils import math as utils_math
+import numpy as np
+
+utils = kfac_jax.utils
+
+
+def _random_psd_matrix(key: utils.PRNGKey, d: int) -> utils.Array:
+  x = jax.random.normal(key, (d, d))
+  return x @ x.T / d + 0.1 * jnp.eye(d)
+
+
+class TestMath(parameterized.TestCase):
+  """Test class for the math utility functions."""
+
+  def assertAllClose(
+      self,
+      x: utils.PyTree,
+      y: utils.PyTree,
+      check_dtypes: bool = True,
+      atol: float = 1e-5,
+      rtol: float = 1e-5,
+  ):
+    """Asserts that the two PyTrees are close up to the provided tolerances."""
+    x_v, x_tree = jax.tree_util.tree_flatten(x)
+    y_v, y_tree = jax.tree_util.tree_flatten(y)
+    self.assertEqual(x_tree, y_tree)
+    for xi, yi in zip(x_v, y_v):
+      self.assertEqual(xi.shape, yi.shape)
+      if check_dtypes:
+        self.assertEqual(xi.dtype, yi.dtype)
+      np.testing.assert_allclose(xi, yi, rtol=rtol, atol=atol)
+
+  @parameterized.parameters(0.0, jnp.nan)
+  def test_pi_adjusted_kronecker_inverse_zero_factor(self, fill_value):
+    """Tests the special case of a zero (or NaN) Kronecker factor."""
+    damping = jnp.asarray(0.25)
+    arrays = (
+        _random_psd_matrix(jax.random.PRNGKey(0), 2),
+        jnp.full((3, 3), fill_value),
+        jnp.ones([4]),
+    )
+
+    cholesky_inputs = []
+    psd_inv_cholesky = utils_math.psd_inv_cholesky
+
+    def recording_psd_inv_cholesky(matrix, damping):
+      cholesky_inputs.append((matrix, damping))
+      return psd_inv_cholesky(matrix, damping)
+
+    with mock.patch.object(
+        utils_math, "psd_inv_cholesky", recording_psd_inv_cholesky):
+      inverses = utils.pi_adjusted_kronecker_inverse(*arrays, damping=damping)
+
+    # Even though its result is discarded, the regular branch is computed, hence
+    # it must not be fed with NaNs.
+    self.assertNotEmpty(cholesky_inputs)
+    for matrix, d_hat in cholesky_inputs:
+      self.assertTrue(np.all(np.isfinite(matrix)))
+      self.assertTrue(np.all(np.isfinite(d_hat)))
+
+    # The inverse is `damping^-1 * I`, split equally across all factors.
+    scale = jnp.power(damping, -1.0 / len(arrays))
+    expected = (
+        scale * jnp.eye(2),
+        scale * jnp.eye(3),
+        scale * jnp.ones([4]),
+    )
+    self.assertAllClose(expected, inverses)
+
+  @parameterized.parameters(
+      (None, False),
+      (((0,), (1, 2), (3,)), True),
+      (((0, 1), (2, 3)), (True, False)),
+  )
+  def test_jit_kronecker_axis_mul_v(self, axis_groups, transpose):
+    """Tests the jitted Kronecker products against the non-jitted ones."""
+    shape = (2, 3, 4, 5)
+    groups = axis_groups or tuple((i,) for i in range(len(shape)))
+    sizes = [int(np.prod([shape[i] for i in group])) for group in groups]
+
+    keys = jax.random.split(jax.random.PRNGKey(0), len(sizes) + 1)
+    factors = [_random_psd_matrix(k, d) for k, d in zip(keys[1:], sizes)]
+    v = jax.random.normal(keys[0], shape)
+    eigenvalues = jnp.abs(v) + 1.0
+
+    expected = utils.kronecker_product_axis_mul_v(
+        factors, v, axis_groups, transpose)
+    # The input `v` is donated, hence we pass a copy of it.
+    result = utils.jit_kronecker_product_axis_mul_v(
+        factors, jnp.array(v), axis_groups=axis_groups, transpose=transpose)
+    self.assertAllClose(expected, result, atol=1e-4, rtol=1e-4)
+
+    expected = utils.kronecker_eigen_basis_axis_mul_v(
+        factors, eigenvalues, v, axis_groups)
+    result = utils.jit_kronecker_eigen_basis_axis_mul_v(
+        factors, eigenvalues, jnp.array(v), axis_groups=axis_groups)
+    self.assertAllClose(expected, result, atol=1e-4, rtol=1e-4)
+
+  def test_jit_kronecker_axis_mul_v_static_args_must_be_hashable(self):
+    """Tests that the static arguments can not be passed as lists."""
+    factors = [jnp.eye(2), jnp.eye(3)]
+    v = jnp.ones((2, 3))
+
+    with self.assertRaises(ValueError):
+      utils.jit_kronecker_product_axis_mul_v(
+          factors, jnp.array(v), axis_groups=[[0], [1]])
+
+    with self.assertRaises(ValueError):
+      utils.jit_kronecker_product_axis_mul_v(
+          factors, jnp.array(v), transpose=[True, False])
+
+    with self.assertRaises(ValueError):
+      utils.jit_kronecker_eigen_basis_axis_mul_v(
+          factors, jnp.ones((2, 3)), jnp.array(v), axis_groups=[[0], [1]])
+
+  @parameterized.parameters(False, True)
+  def test_safe_psd_eigh_assume_finite(self, force_on_host):
+    """Tests that `assume_finite=True` matches the default path."""
+    x = _random_psd_matrix(jax.random.PRNGKey(2), 5)
+
+    s, q = utils.safe_psd_eigh(x)
+    s_fast, q_fast = jax.jit(
+        lambda x: utils.safe_psd_eigh(  # pylint: disable=g-long-lambda
+            x, force_on_host=force_on_host, assume_finite=True))(x)
+
+    self.assertAllClose(s, s_fast, atol=1e-4, rtol=1e-4)
+    self.assertAllClose(jnp.abs(q), jnp.abs(q_fast), atol=1e-4, rtol=1e-4)
+
+  def test_safe_psd_eigh_compute_dtype(self):
+    """Tests computing the decomposition of a bfloat16 matrix in float32."""
+    # A rank deficient matrix, so that some eigenvalues are (close to) zero.
+    y = jax.random.normal(jax.random.PRNGKey(3), (6, 3))
+    x = (y @ y.T).astype(jnp.bfloat16)
+
+    s, q = utils.safe_psd_eigh(x, compute_dtype=jnp.float32)
+    s_32, _ = utils.safe_psd_eigh(x.astype(jnp.float32))
+
+    self.assertEqual(s.dtype, jnp.bfloat16)
+    self.assertEqual(q.dtype, jnp.bfloat16)
+    self.assertTrue(np.all(np.asarray(s, dtype=np.float32) >= 0.0))
+    np.testing.assert_allclose(
+        np.asarray(s, dtype=np.float32), s_32, atol=5e-2, rtol=1e-2)
+
+  @parameterized.parameters(False, True)
+  def test_safe_psd_eigh_unsorted(self, assume_finite):
+    """Tests that unsorted eigenvalues are paired with their eigenvectors."""
+    x = _random_psd_matrix(jax.random.PRNGKey(4), 6)
+
+    s, q = jax.jit(
+        lambda x: utils.safe_psd_eigh(  # pylint: disable=g-long-lambda
+            x, assume_finite=assume_finite, sort_eigenvalues=False))(x)
+
+    self.assertEqual(s.shape, (6,))
+    self.assertEqual(q.shape, (6, 6))
+    self.assertAllClose(x, q @ jnp.diag(s) @ q.T, atol=1e-4, rtol=1e-4)
+
+  @parameterized.parameters(False, True)
+  def test_safe_psd_eigh_stacked(self, force_on_host):
+    """Tests `safe_psd_eigh` on a stack of matrices, one of which is NaN."""
+    keys = jax.random.split(jax.random.PRNGKey(0), 3)
+    matrices = jnp.stack([_random_psd_matrix(key, 4) for key in keys])
+    matrices = matrices.at[1].set(jnp.nan)
+
+    eigh = jax.jit(
+        lambda x: utils.safe_psd_eigh(x, force_on_host=force_on_host))
+    s, q = eigh(matrices)
+
+    self.assertEqual(s.shape, (3, 4))
+    self.assertEqual(q.shape, (3, 4, 4))
+
+    # Only the NaN matrix produces NaNs.
+    self.assertTrue(np.all(np.isnan(s[1])))
+    self.assertTrue(np.all(np.isnan(q[1])))
+
+    for i in (0, 2):
+      s_i, q_i = eigh(matrices[i])
+      self.assertAllClose(s_i, s[i], atol=1e-4, rtol=1e-4)
+      # Eigenvectors are only defined up to a sign.
+      self.assertAllClose(jnp.abs(q_i), jnp.abs(q[i]), atol=1e-4, rtol=1e-4)
+
+  @parameterized.parameters(False, True)
+  def test_safe_psd_eigh_vmap(self, force_on_host):
+    """Tests `jax.vmap` over `safe_psd_eigh` on single matrices."""
+    keys = jax.random.split(jax.random.PRNGKey(1), 3)
+    matrices = jnp.stack([_random_psd_matrix(key, 4) for key in keys])
+
+    eigh = jax.jit(
+        lambda x: utils.safe_psd_eigh(x, force_on_host=force_on_host))
+    s, q = jax.vmap(eigh)(matrices)
+
+    for i in range(matrices.shape[0]):
+      s_i, q_i = eigh(matrices[i])
+      self.assertAllClose(s_i, s[i], atol=1e-4, rtol=1e-4)
+      self.assertAllClose(jnp.abs(q_i), jnp.abs(q[i]), atol=1e-4, rtol=1e-4)
+
+
+if __name__ == "__main__":
+  absltest.main()